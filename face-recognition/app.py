@@ -1,10 +1,25 @@
-from flask import Flask, request, jsonify
+import os
+
+# Cap BLAS/OpenMP thread pools before numpy/dlib load them; otherwise each gunicorn
+# worker spawns one thread per core and they thrash against each other
+os.environ.setdefault('OMP_NUM_THREADS', '2')
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '2')
+
+from flask import Flask, Response, request, jsonify
 import face_recognition
 import numpy as np
+import orjson
+import base64
 from PIL import Image
 import io
 import logging
-import os
+import threading
+from numba import njit
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu has no wheel for every platform (e.g. the Windows dev setup)
+    faiss = None
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +29,138 @@ logger = logging.getLogger(__name__)
 # Set USE_CNN_MODEL=true in environment to enable
 USE_CNN_MODEL = os.getenv('USE_CNN_MODEL', 'false').lower() == 'true'
 
+# Smallest side JPEGs are decoded at (libjpeg scales by 1/2, 1/4 or 1/8 to stay above it)
+DRAFT_SIZE = int(os.getenv('DRAFT_SIZE', '1280'))
+
+# libjpeg-turbo decoder (SIMD, runs outside the GIL); other formats go through PIL
+JPEG_MAGIC = b'\xff\xd8\xff'
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    jpeg = TurboJPEG()
+except (ImportError, RuntimeError):  # PyTurboJPEG or the libturbojpeg shared library is missing
+    jpeg = None
+
+# Largest /detect request body; also the largest per-thread upload buffer kept between requests
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', str(32 * 1024 * 1024)))
+
+# Per-thread upload buffer, grown as needed and reused across requests
+upload_buffers = threading.local()
+# Bytes copied per read when the upload stream has no readinto
+UPLOAD_CHUNK = 1 << 20
+
+# Maximum euclidean distance between encodings of the same person
+CLUSTER_EPS = 0.5
+
+
+def read_upload(stream):
+    """Read an upload stream into this thread's reusable buffer and return a view of its contents"""
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    buffer = getattr(upload_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+        # Chunked uploads have no Content-Length for detect_faces to check, so an
+        # oversized one gets a buffer of its own that is freed after the request
+        if size <= MAX_UPLOAD_SIZE:
+            upload_buffers.buffer = buffer
+    view = memoryview(buffer)[:size]
+
+    # Werkzeug spools uploads to a SpooledTemporaryFile, which has no readinto before Python 3.11
+    readinto = getattr(stream, 'readinto', None)
+    offset = 0
+    while offset < size:
+        if readinto is not None:
+            count = readinto(view[offset:])
+        else:
+            chunk = stream.read(min(UPLOAD_CHUNK, size - offset))
+            count = len(chunk)
+            view[offset:offset + count] = chunk
+        if not count:
+            break
+        offset += count
+    return view[:offset]
+
+
+def decode_image(stream):
+    """
+    Decode an uploaded image stream into an RGB array, downscaled by 1/2, 1/4 or 1/8
+    during decode while both sides stay at least DRAFT_SIZE.
+
+    Returns the array and the original (width, height).
+    """
+    if jpeg is not None and stream.read(3) == JPEG_MAGIC:
+        image_bytes = read_upload(stream)
+        try:
+            width, height, _, _ = jpeg.decode_header(image_bytes)
+            denominator = next((d for d in (8, 4, 2) if min(width, height) // DRAFT_SIZE >= d), 1)
+            return jpeg.decode(image_bytes, pixel_format=TJPF_RGB, scaling_factor=(1, denominator)), (width, height)
+        except OSError as e:
+            # e.g. CMYK JPEGs, which libjpeg-turbo cannot convert to RGB
+            logger.debug(f"TurboJPEG decode failed, falling back to PIL: {e}")
+    stream.seek(0)
+
+    # PIL reads the stream directly, without an intermediate bytes copy
+    image = Image.open(stream)
+    size = image.size
+    # Let libjpeg downscale during decode (no-op for other formats)
+    image.draft('RGB', (DRAFT_SIZE, DRAFT_SIZE))
+    return np.asarray(image.convert('RGB')), size
+
+
+@njit(cache=True, fastmath=True)
+def eye_distance_ratio(left_eye, right_eye, width):
+    """Distance between the eye centers relative to face width (0 for a degenerate box)"""
+    if width <= 0:
+        return 0.0
+    lx = ly = rx = ry = 0.0
+    for i in range(left_eye.shape[0]):
+        lx += left_eye[i, 0]
+        ly += left_eye[i, 1]
+    for i in range(right_eye.shape[0]):
+        rx += right_eye[i, 0]
+        ry += right_eye[i, 1]
+    dx = lx / left_eye.shape[0] - rx / right_eye.shape[0]
+    dy = ly / left_eye.shape[0] - ry / right_eye.shape[0]
+    return np.sqrt(dx * dx + dy * dy) / width
+
+
+def neighbor_graph(encodings):
+    """
+    Build a sparse CSR graph of euclidean distances between encodings closer than CLUSTER_EPS.
+
+    Uses an exact FAISS range search (BLAS/SIMD distance scans) when faiss is
+    installed, otherwise a scikit-learn ball tree.
+    """
+    from sklearn.neighbors import sort_graph_by_row_values
+
+    # DBSCAN(metric='precomputed') wants each row's entries sorted by distance
+    return sort_graph_by_row_values(unsorted_neighbor_graph(encodings), warn_when_not_sorted=False)
+
+
+def unsorted_neighbor_graph(encodings):
+    """Build the neighbor_graph() edges, in whatever order the search returns them"""
+    if faiss is None:
+        from sklearn.neighbors import NearestNeighbors
+
+        nn = NearestNeighbors(radius=CLUSTER_EPS, algorithm='ball_tree', n_jobs=-1).fit(encodings)
+        return nn.radius_neighbors_graph(encodings, mode='distance')
+
+    from scipy.sparse import csr_matrix
+
+    vectors = np.ascontiguousarray(encodings, dtype=np.float32)
+    n, dim = vectors.shape
+
+    # Exact search on the raw encodings keeps the same eps as the ball tree path.
+    # FAISS takes squared radii and compares in float32, so pad the radius to keep
+    # pairs at exactly eps; DBSCAN drops anything that ends up beyond eps.
+    index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    lims, squared_distances, neighbors = index.range_search(vectors, (CLUSTER_EPS * (1 + 1e-5)) ** 2)
+    distances = np.sqrt(np.maximum(squared_distances, 0))
+    return csr_matrix((distances, neighbors, lims.astype(np.int64)), shape=(n, n))
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -25,19 +172,30 @@ def detect_faces():
     Detect faces in an image and return face locations and encodings.
 
     Expected input: multipart/form-data with 'image' file
+    Optional query parameter: encoding_format=base64 returns each encoding as
+    base64 of 128 little-endian float32 values instead of a list of floats
     Returns: JSON with face locations and encodings
     """
     try:
+        # Only /detect is limited; /cluster bodies grow with the number of encodings
+        if request.content_length is not None and request.content_length > MAX_UPLOAD_SIZE:
+            return jsonify({"error": f"Upload larger than {MAX_UPLOAD_SIZE} bytes"}), 413
+
         if 'image' not in request.files:
             return jsonify({"error": "No image provided"}), 400
 
+        base64_encodings = request.args.get('encoding_format', 'float') == 'base64'
+
         image_file = request.files['image']
-        image_bytes = image_file.read()
 
         # Load image
-        image = Image.open(io.BytesIO(image_bytes))
-        image_array = np.array(image.convert('RGB'))
+        image_array, (orig_width, orig_height) = decode_image(image_file.stream)
         img_height, img_width = image_array.shape[:2]
+        scale = orig_width / img_width
+        if scale != 1:
+            # HOG finds faces down to ~40px with one upsample, so this is the smallest face kept in the original
+            logger.info(f"Decoded {orig_width}x{orig_height} image at {img_width}x{img_height}; "
+                        f"faces smaller than ~{int(40 * scale)}px may be missed")
 
         # Detect faces - CNN model is more accurate but slower
         model = 'cnn' if USE_CNN_MODEL else 'hog'
@@ -50,31 +208,31 @@ def detect_faces():
                 "count": 0
             }), 200
 
-        # Get face landmarks for validation (detects facial features)
-        face_landmarks_list = face_recognition.face_landmarks(image_array, face_locations)
+        # Filter out faces that are likely false positives by box geometry first,
+        # so the landmark predictor only runs on plausible candidates
+        locs = np.array(face_locations, dtype=np.int32)
+        heights = locs[:, 2] - locs[:, 0]
+        widths = locs[:, 1] - locs[:, 3]
+        aspect_ratios = widths / np.maximum(heights, 1)
 
-        # Filter out faces that are likely false positives
-        filtered_locations = []
-        for idx, (top, right, bottom, left) in enumerate(face_locations):
-            width = right - left
-            height = bottom - top
+        # Filter by size - minimum 1% of image, maximum 95%
+        min_size = min(img_width, img_height) * 0.01  # Increased from 0.005 to reduce false positives
+        max_size = min(img_width, img_height) * 0.95
+        keep = (widths >= min_size) & (heights >= min_size) & (widths <= max_size) & (heights <= max_size)
 
-            # Filter by size - minimum 1% of image, maximum 95%
-            min_size = min(img_width, img_height) * 0.01  # Increased from 0.005 to reduce false positives
-            max_size = min(img_width, img_height) * 0.95
+        # Filter by aspect ratio - real faces are 0.7 to 1.3 (stricter than before)
+        keep &= (aspect_ratios >= 0.7) & (aspect_ratios <= 1.3)
 
-            if width < min_size or height < min_size:
-                logger.debug(f"Filtered out face: too small ({width}x{height})")
-                continue
-            if width > max_size or height > max_size:
-                logger.debug(f"Filtered out face: too large ({width}x{height})")
-                continue
+        geom_ok = [face_locations[i] for i in np.nonzero(keep)[0]]
+        if len(geom_ok) < len(face_locations):
+            logger.debug(f"Filtered out {len(face_locations) - len(geom_ok)} face(s) by size or aspect ratio")
 
-            # Filter by aspect ratio - real faces are 0.7 to 1.3 (stricter than before)
-            aspect_ratio = width / height if height > 0 else 0
-            if aspect_ratio < 0.7 or aspect_ratio > 1.3:
-                logger.debug(f"Filtered out face: bad aspect ratio ({aspect_ratio:.2f})")
-                continue
+        # Get face landmarks for validation (detects facial features)
+        face_landmarks_list = face_recognition.face_landmarks(image_array, geom_ok) if geom_ok else []
+
+        filtered_locations = []
+        for idx, (top, right, bottom, left) in enumerate(geom_ok):
+            width = right - left
 
             # Validate facial landmarks - must have key facial features
             if idx < len(face_landmarks_list):
@@ -88,14 +246,13 @@ def detect_faces():
                     continue
 
                 # Check if eyes are properly positioned (not too close, not too far)
-                left_eye = np.array(landmarks['left_eye'])
-                right_eye = np.array(landmarks['right_eye'])
-                eye_distance = np.linalg.norm(left_eye.mean(axis=0) - right_eye.mean(axis=0))
+                left_eye = np.asarray(landmarks['left_eye'], dtype=np.float32)
+                right_eye = np.asarray(landmarks['right_eye'], dtype=np.float32)
 
                 # Eye distance should be roughly 30-70% of face width
-                eye_distance_ratio = eye_distance / width if width > 0 else 0
-                if eye_distance_ratio < 0.25 or eye_distance_ratio > 0.75:
-                    logger.debug(f"Filtered out face: abnormal eye distance ratio ({eye_distance_ratio:.2f})")
+                eye_ratio = eye_distance_ratio(left_eye, right_eye, width)
+                if eye_ratio < 0.25 or eye_ratio > 0.75:
+                    logger.debug(f"Filtered out face: abnormal eye distance ratio ({eye_ratio:.2f})")
                     continue
 
             filtered_locations.append((top, right, bottom, left))
@@ -113,7 +270,8 @@ def detect_faces():
         # Format response
         faces = []
         for location, encoding in zip(filtered_locations, face_encodings):
-            top, right, bottom, left = location
+            # Report locations in original image coordinates
+            top, right, bottom, left = (int(round(v * scale)) for v in location)
             faces.append({
                 "location": {
                     "top": int(top),
@@ -123,15 +281,17 @@ def detect_faces():
                     "width": int(right - left),
                     "height": int(bottom - top)
                 },
-                "encoding": encoding.tolist()
+                "encoding": (base64.b64encode(encoding.astype('<f4').tobytes()).decode('ascii')
+                             if base64_encodings else encoding)
             })
 
         logger.info(f"Detected {len(faces)} face(s)")
 
-        return jsonify({
+        # orjson writes the numpy encodings straight from their buffers
+        return Response(orjson.dumps({
             "faces": faces,
             "count": len(faces)
-        }), 200
+        }, option=orjson.OPT_SERIALIZE_NUMPY), status=200, mimetype='application/json')
 
     except Exception as e:
         logger.error(f"Error detecting faces: {str(e)}")
@@ -159,9 +319,13 @@ def cluster_faces():
         # Use face_recognition's built-in clustering
         from sklearn.cluster import DBSCAN
 
+        # Build a sparse eps-neighborhood graph instead of letting DBSCAN
+        # materialize all pairwise distances
+        graph = neighbor_graph(encodings)
+
         # DBSCAN clustering with tolerance for face distance
-        clustering = DBSCAN(eps=0.5, min_samples=2, metric='euclidean')
-        labels = clustering.fit_predict(encodings)
+        clustering = DBSCAN(eps=CLUSTER_EPS, min_samples=2, metric='precomputed')
+        labels = clustering.fit_predict(graph)
 
         # Convert numpy int64 to Python int for JSON serialization
         clusters = [int(label) for label in labels]
@@ -177,5 +341,20 @@ def cluster_faces():
         logger.error(f"Error clustering faces: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def warm_up():
+    """Run one dummy detection so this process's first request doesn't pay for thread-pool and cache setup"""
+    logger.info("Warming up face detection...")
+    model = 'cnn' if USE_CNN_MODEL else 'hog'
+    face_recognition.face_locations(np.zeros((320, 320, 3), dtype=np.uint8), model=model)
+    logger.info("Face detection warm")
+
+
+# Compile (or load from the numba cache) the landmark check at import; with gunicorn's
+# preload_app this happens once in the master and workers inherit it. Detection is
+# warmed per process instead (see warm_up and gunicorn_conf.post_fork), because
+# BLAS/OpenMP thread pools don't survive fork.
+eye_distance_ratio(np.zeros((6, 2), dtype=np.float32), np.ones((6, 2), dtype=np.float32), 1)
+
 if __name__ == '__main__':
+    warm_up()
     app.run(host='0.0.0.0', port=5555, debug=False)
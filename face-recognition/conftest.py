@@ -0,0 +1,2 @@
+# test_api.py is a manual smoke test against a running service, not a pytest module
+collect_ignore = ['test_api.py']
@@ -0,0 +1,15 @@
+# Gunicorn settings for the face-recognition service.
+# HOG detection is CPU-bound, so run several processes; preloading the app
+# loads the dlib models once in the master and shares them copy-on-write.
+bind = '0.0.0.0:5555'
+workers = 4
+threads = 2
+preload_app = True
+timeout = 120
+
+
+def post_fork(server, worker):
+    # Thread pools are per process, so warm up detection in each worker, not the master
+    from app import warm_up
+
+    warm_up()
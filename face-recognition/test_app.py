@@ -0,0 +1,200 @@
+import base64
+import io
+import json
+import threading
+import warnings
+
+import numpy as np
+import pytest
+from PIL import Image
+from sklearn.cluster import DBSCAN
+
+import app
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+class PilJpegDecoder:
+    """Stand-in with TurboJPEG's decode API for machines without the libturbojpeg shared library"""
+
+    def __init__(self):
+        self.decoded = 0
+
+    def decode_header(self, jpeg_buf):
+        width, height = Image.open(io.BytesIO(jpeg_buf)).size
+        return width, height, 0, 0
+
+    def decode(self, jpeg_buf, pixel_format=None, scaling_factor=(1, 1)):
+        self.decoded += 1
+        image = Image.open(io.BytesIO(jpeg_buf))
+        numerator, denominator = scaling_factor
+        width, height = image.size
+        size = (-(-width * numerator // denominator), -(-height * numerator // denominator))
+        return np.asarray(image.convert('RGB').resize(size))
+
+
+@pytest.fixture
+def jpeg_decoder(monkeypatch):
+    """Make sure /detect takes the TurboJPEG branch, with the real library when it is installed"""
+    if app.jpeg is None:
+        monkeypatch.setattr(app, 'jpeg', PilJpegDecoder())
+        monkeypatch.setattr(app, 'TJPF_RGB', 0, raising=False)
+    return app.jpeg
+
+
+@pytest.fixture
+def fake_face(monkeypatch):
+    """Detect one face with plausible landmarks at (top=20, right=60, bottom=60, left=20) in the decoded image"""
+    encoding = np.linspace(-0.25, 0.25, 128)
+    detected_shapes = []
+
+    def face_locations(image, **kwargs):
+        detected_shapes.append(image.shape)
+        return [(20, 60, 60, 20)]
+
+    landmarks = {
+        'left_eye': [(28, 34), (30, 33), (32, 33), (34, 34), (32, 35), (30, 35)],
+        'right_eye': [(46, 34), (48, 33), (50, 33), (52, 34), (50, 35), (48, 35)],
+        'nose_tip': [(38, 45), (40, 46), (42, 45)],
+        'top_lip': [(34, 52), (40, 51), (46, 52)],
+        'bottom_lip': [(34, 54), (40, 55), (46, 54)],
+    }
+    monkeypatch.setattr(app.face_recognition, 'face_locations', face_locations)
+    monkeypatch.setattr(app.face_recognition, 'face_landmarks', lambda image, locations: [landmarks] * len(locations))
+    monkeypatch.setattr(app.face_recognition, 'face_encodings', lambda image, locations: [encoding] * len(locations))
+    return encoding, detected_shapes
+
+
+def post_jpeg(client, size, query=''):
+    image = io.BytesIO()
+    Image.new('RGB', size, 'white').save(image, format='JPEG')
+    image.seek(0)
+    return client.post('/detect' + query, data={'image': (image, 'test.jpg', 'image/jpeg')},
+                       content_type='multipart/form-data')
+
+
+def make_encodings(people=20, faces_per_person=10, seed=0):
+    """Encodings that form one tight group per person, like dlib descriptors of the same face"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 0.1, (people, 128))
+    return np.concatenate([center + rng.normal(0, 0.02, (faces_per_person, 128)) for center in centers])
+
+
+def test_cluster_matches_plain_dbscan(client):
+    encodings = make_encodings()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        response = client.post('/cluster', json={'encodings': encodings.tolist()})
+
+    assert response.status_code == 200
+    expected = DBSCAN(eps=app.CLUSTER_EPS, min_samples=2).fit_predict(encodings)
+    assert response.json['clusters'] == expected.tolist()
+    assert response.json['unique_clusters'] == 20
+
+
+def test_cluster_ball_tree_fallback_matches_plain_dbscan(client, monkeypatch):
+    monkeypatch.setattr(app, 'faiss', None)
+    encodings = make_encodings()
+
+    response = client.post('/cluster', json={'encodings': encodings.tolist()})
+
+    assert response.status_code == 200
+    expected = DBSCAN(eps=app.CLUSTER_EPS, min_samples=2).fit_predict(encodings)
+    assert response.json['clusters'] == expected.tolist()
+
+
+def test_cluster_groups_identical_encodings(client):
+    response = client.post('/cluster', json={'encodings': [[0.1] * 128, [0.1] * 128, [0.9] * 128]})
+
+    assert response.status_code == 200
+    assert response.json['clusters'] == [0, 0, -1]
+
+
+def test_detect_decodes_jpeg_upload_stream(client, jpeg_decoder, monkeypatch):
+    monkeypatch.setattr(app, 'DRAFT_SIZE', 100)
+    decode = jpeg_decoder.decode
+    decoded_shapes = []
+
+    def spy(*args, **kwargs):
+        array = decode(*args, **kwargs)
+        decoded_shapes.append(array.shape)
+        return array
+
+    monkeypatch.setattr(jpeg_decoder, 'decode', spy)
+    image = io.BytesIO()
+    Image.new('RGB', (640, 480), 'white').save(image, format='JPEG')
+    image.seek(0)
+
+    response = client.post('/detect', data={'image': (image, 'test.jpg', 'image/jpeg')},
+                           content_type='multipart/form-data')
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert response.json == {'faces': [], 'count': 0}
+    # 480 // 100 = 4, so the JPEG is decoded at a quarter of its size
+    assert decoded_shapes == [(120, 160, 3)]
+
+
+def test_detect_reports_locations_in_original_coordinates(client, jpeg_decoder, fake_face, monkeypatch):
+    monkeypatch.setattr(app, 'DRAFT_SIZE', 100)
+    _, detected_shapes = fake_face
+
+    response = post_jpeg(client, (640, 480))
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    # Detected on the quarter-size decode, reported at full size
+    assert detected_shapes == [(120, 160, 3)]
+    assert response.json['count'] == 1
+    assert response.json['faces'][0]['location'] == {
+        'top': 80, 'right': 240, 'bottom': 240, 'left': 80, 'width': 160, 'height': 160,
+    }
+
+
+def test_detect_serializes_encodings_as_floats(client, fake_face):
+    encoding, _ = fake_face
+
+    response = post_jpeg(client, (160, 120))
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    # orjson must write the same floats as json.dumps(encoding.tolist()) did
+    assert response.json['faces'][0]['encoding'] == json.loads(json.dumps(encoding.tolist()))
+
+
+def test_detect_serializes_encodings_as_base64_float32(client, fake_face):
+    encoding, _ = fake_face
+
+    response = post_jpeg(client, (160, 120), '?encoding_format=base64')
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    decoded = np.frombuffer(base64.b64decode(response.json['faces'][0]['encoding']), '<f4')
+    np.testing.assert_array_equal(decoded, encoding.astype(np.float32))
+
+
+def test_detect_rejects_uploads_over_max_upload_size(client, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_UPLOAD_SIZE', 1024)
+
+    response = post_jpeg(client, (640, 480))
+
+    assert response.status_code == 413
+    assert 'error' in response.json
+
+
+def test_cluster_accepts_bodies_over_max_upload_size(client, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_UPLOAD_SIZE', 1024)
+
+    response = client.post('/cluster', json={'encodings': make_encodings().tolist()})
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert response.json['unique_clusters'] == 20
+
+
+def test_read_upload_keeps_no_buffer_over_max_upload_size(monkeypatch):
+    monkeypatch.setattr(app, 'upload_buffers', threading.local())
+    monkeypatch.setattr(app, 'MAX_UPLOAD_SIZE', 1024)
+
+    assert app.read_upload(io.BytesIO(b'x' * 2048)) == b'x' * 2048
+    assert getattr(app.upload_buffers, 'buffer', None) is None
+    assert app.read_upload(io.BytesIO(b'y' * 512)) == b'y' * 512
+    assert len(app.upload_buffers.buffer) == 512
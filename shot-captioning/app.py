@@ -1,6 +1,12 @@
 from flask import Flask, request, jsonify
 import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import xxhash
 from PIL import Image
+import numpy as np
 import torch
 from transformers import Blip2Processor, Blip2ForConditionalGeneration
 import logging
@@ -15,36 +21,177 @@ logger = logging.getLogger(__name__)
 # Model configuration
 MODEL_NAME = os.getenv('MODEL_NAME', 'Salesforce/blip2-opt-2.7b')
 device = "cuda" if torch.cuda.is_available() else "cpu"
+# Model weight dtype: fp16 uses GPU tensor cores; on CPU bf16 only pays off with
+# AVX512-BF16/AMX, and is slower than fp32 elsewhere, so CPU defaults to float32
+MODEL_DTYPE = os.getenv('MODEL_DTYPE', 'float16' if device == "cuda" else 'float32')
+dtype = {'float16': torch.float16, 'bfloat16': torch.bfloat16, 'float32': torch.float32}[MODEL_DTYPE]
+# Number of images sent through a single model.generate call
+CAPTION_BATCH_SIZE = int(os.getenv('CAPTION_BATCH_SIZE', '8'))
+# Number of captions remembered by image content hash
+CAPTION_CACHE_SIZE = int(os.getenv('CAPTION_CACHE_SIZE', '4096'))
+# Compile the vision encoder with torch.compile (on by default on GPU)
+TORCH_COMPILE = os.getenv('TORCH_COMPILE', 'true' if device == "cuda" else 'false').lower() == 'true'
 
 # Load model at startup
-logger.info(f"Loading model {MODEL_NAME} on device {device}...")
+logger.info(f"Loading model {MODEL_NAME} on device {device} ({dtype})...")
 processor = Blip2Processor.from_pretrained(MODEL_NAME)
-model = Blip2ForConditionalGeneration.from_pretrained(MODEL_NAME, torch_dtype=torch.float32).to(device)
-logger.info("Model loaded successfully")
+try:
+    # Fused scaled-dot-product attention (FlashAttention / memory-efficient kernels on GPU)
+    # instead of materializing the full attention matrix
+    model = Blip2ForConditionalGeneration.from_pretrained(MODEL_NAME, torch_dtype=dtype, attn_implementation='sdpa')
+except ValueError as e:
+    # Older transformers releases don't implement SDPA for BLIP-2
+    logger.warning(f"SDPA attention not available, using eager attention: {e}")
+    model = Blip2ForConditionalGeneration.from_pretrained(MODEL_NAME, torch_dtype=dtype)
+model = model.to(device)
+if TORCH_COMPILE:
+    # Inductor fuses LayerNorm/GELU/matmul epilogues; reduce-overhead replays CUDA graphs.
+    # Input shape only varies with batch size (1..CAPTION_BATCH_SIZE); warm_up() captures each one.
+    model.vision_model = torch.compile(model.vision_model, mode='reduce-overhead')
+logger.info(f"Model loaded successfully (attention: {model.config._attn_implementation})")
+
+
+# Decodes the next batch of images while the model works on the current one
+decode_pool = ThreadPoolExecutor(max_workers=4)
+
+# Every caption_batch call runs on this single thread: request threads share one GPU,
+# and torch.compile's CUDA graphs are recorded per thread with static output buffers,
+# so they must be replayed on the thread that captured them, one call at a time
+model_pool = ThreadPoolExecutor(max_workers=1)
+
+# libjpeg-turbo decoder (SIMD, runs outside the GIL so decode_pool threads overlap); other formats go through PIL
+JPEG_MAGIC = b'\xff\xd8\xff'
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJFLAG_FASTDCT
+    jpeg = TurboJPEG()
+except (ImportError, RuntimeError):  # PyTurboJPEG or the libturbojpeg shared library is missing
+    jpeg = None
+# The processor resizes to the model input anyway, so JPEGs are decoded at 1/2, 1/4 or 1/8
+# scale as long as both sides stay at least this large
+MODEL_INPUT_SIZE = min(processor.image_processor.size['height'], processor.image_processor.size['width'])
+
+
+# LRU of image content hash -> caption, so retries of the same image skip the model
+caption_cache = OrderedDict()
+caption_cache_lock = threading.Lock()
+
+
+def cached_caption(key):
+    """Return the cached caption for an image hash, or None"""
+    with caption_cache_lock:
+        caption = caption_cache.get(key)
+        if caption is not None:
+            caption_cache.move_to_end(key)
+        return caption
 
 
-def generate_caption(image_bytes):
-    """Generate caption for image using BLIP model"""
-    try:
-        # Load image
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        logger.info(f"Loaded image: size={image.size}, mode={image.mode}")
+def cache_caption(key, caption):
+    """Remember a caption for an image hash, evicting the least recently used one"""
+    with caption_cache_lock:
+        caption_cache[key] = caption
+        caption_cache.move_to_end(key)
+        if len(caption_cache) > CAPTION_CACHE_SIZE:
+            caption_cache.popitem(last=False)
 
-        # Process image
-        inputs = processor(images=image, return_tensors="pt").to(device)
 
-        # Generate caption
-        with torch.no_grad():
-            outputs = model.generate(**inputs, max_length=50, num_beams=5)
+def decode_image(image_bytes):
+    """Decode an image blob into an RGB array"""
+    if jpeg is not None and image_bytes[:3] == JPEG_MAGIC:
+        try:
+            width, height, _, _ = jpeg.decode_header(image_bytes)
+            denominator = next((d for d in (8, 4, 2) if min(width, height) // MODEL_INPUT_SIZE >= d), 1)
+            return jpeg.decode(image_bytes, pixel_format=TJPF_RGB, scaling_factor=(1, denominator),
+                               flags=TJFLAG_FASTDCT)
+        except OSError as e:
+            # e.g. CMYK JPEGs, which libjpeg-turbo cannot convert to RGB
+            logger.debug(f"TurboJPEG decode failed, falling back to PIL: {e}")
 
-        caption = processor.decode(outputs[0], skip_special_tokens=True)
-        logger.info(f"Generated caption: {caption}")
-        return caption
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('RGB', (MODEL_INPUT_SIZE, MODEL_INPUT_SIZE))
+    return np.asarray(image.convert('RGB'))
+
+
+def load_images(images_bytes):
+    """Decode a batch of image blobs into RGB arrays, or the exception for a blob that fails to decode"""
+    images = []
+    for image_bytes in images_bytes:
+        try:
+            image = decode_image(image_bytes)
+            logger.info(f"Loaded image: shape={image.shape}")
+        except Exception as e:
+            logger.warning(f"Could not decode image: {e}")
+            image = e
+        images.append(image)
+    return images
+
+
+def caption_batch(images):
+    """Run BLIP on a batch of decoded images in a single generate call"""
+    inputs = processor(images=images, return_tensors="pt", padding=True).to(device, model.dtype)
+
+    with torch.inference_mode(), torch.autocast(device, dtype=model.dtype, enabled=model.dtype != torch.float32):
+        outputs = model.generate(**inputs, max_length=50, num_beams=5, use_cache=True)
+
+    return processor.batch_decode(outputs, skip_special_tokens=True)
+
+
+def generate_captions(images_bytes):
+    """
+    Generate captions for a list of images using BLIP model, CAPTION_BATCH_SIZE at a time.
+
+    Returns the captions and the decode errors, both in upload order; each image
+    has either a caption or an error, and None in the other list.
+    """
+    try:
+        keys = [xxhash.xxh3_128_hexdigest(image_bytes) for image_bytes in images_bytes]
+        captions = {key: cached_caption(key) for key in keys}
+        errors = {}
+        misses = {key: image_bytes for key, image_bytes in zip(keys, images_bytes) if captions[key] is None}
+        logger.info(f"Caption cache: {len(keys) - len(misses)} hit(s), {len(misses)} miss(es), "
+                    f"{len(caption_cache)}/{CAPTION_CACHE_SIZE} entries")
+
+        it = iter(misses.items())
+        batches = list(iter(lambda: list(islice(it, CAPTION_BATCH_SIZE)), []))
+        if batches:
+            next_images = decode_pool.submit(load_images, [image_bytes for _, image_bytes in batches[0]])
+        for i in range(len(batches)):
+            images = next_images.result()
+            if i + 1 < len(batches):
+                next_images = decode_pool.submit(load_images, [image_bytes for _, image_bytes in batches[i + 1]])
+
+            decoded = []
+            for (key, _), image in zip(batches[i], images):
+                if isinstance(image, Exception):
+                    errors[key] = str(image)
+                else:
+                    decoded.append((key, image))
+            if not decoded:
+                continue
+
+            batch_captions = model_pool.submit(caption_batch, [image for _, image in decoded]).result()
+            logger.info(f"Generated {len(batch_captions)} caption(s): {batch_captions}")
+            for (key, _), caption in zip(decoded, batch_captions):
+                captions[key] = caption
+                cache_caption(key, caption)
+        return [captions[key] for key in keys], [errors.get(key) for key in keys]
     except Exception as e:
-        logger.error(f"Error generating caption: {e}", exc_info=True)
+        logger.error(f"Error generating captions: {e}", exc_info=True)
         raise
 
 
+def warm_up():
+    """Caption every batch size once so compilation and CUDA graph capture happen before the first request"""
+    logger.info("Warming up model...")
+    blank = np.zeros((MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, 3), dtype=np.uint8)
+    for batch_size in range(1, CAPTION_BATCH_SIZE + 1):
+        model_pool.submit(caption_batch, [blank] * batch_size).result()
+    logger.info("Model warm")
+
+
+if TORCH_COMPILE:
+    warm_up()
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -54,23 +201,31 @@ def health():
 @app.route('/caption', methods=['POST'])
 def caption_image():
     """
-    Generate caption for a single image.
-    Expected input: multipart/form-data with 'image' file
-    Returns: JSON with caption
+    Generate captions for one or more images.
+    Expected input: multipart/form-data with one or more 'image' files
+    Returns: JSON with captions and errors in upload order, plus caption for a single image;
+    400 if no image could be decoded
     """
     if 'image' not in request.files:
         return jsonify({"error": "No image file provided"}), 400
 
-    image_file = request.files['image']
-    image_bytes = image_file.read()
+    images_bytes = [image_file.read() for image_file in request.files.getlist('image')]
 
     try:
-        caption = generate_caption(image_bytes)
-        return jsonify({"caption": caption}), 200
+        captions, errors = generate_captions(images_bytes)
     except Exception as e:
         logger.error(f"Error processing image: {e}")
         return jsonify({"error": str(e)}), 500
 
+    response = {"captions": captions, "errors": errors}
+    if len(captions) == 1:
+        # Kept for clients written against the single-image API
+        response["caption"] = captions[0]
+    if all(caption is None for caption in captions):
+        response["error"] = "No image could be decoded"
+        return jsonify(response), 400
+    return jsonify(response), 200
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5556)
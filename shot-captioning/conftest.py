@@ -0,0 +1,13 @@
+# app.py loads BLIP-2 at import; tests stub caption_batch, so load stand-ins instead of the real weights
+import os
+from unittest import mock
+
+import transformers
+
+os.environ['TORCH_COMPILE'] = 'false'
+
+processor = mock.MagicMock()
+processor.image_processor.size = {'height': 224, 'width': 224}
+mock.patch.object(transformers.Blip2Processor, 'from_pretrained', return_value=processor).start()
+mock.patch.object(transformers.Blip2ForConditionalGeneration, 'from_pretrained',
+                  return_value=mock.MagicMock()).start()
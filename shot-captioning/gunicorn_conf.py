@@ -0,0 +1,18 @@
+# Gunicorn settings for the shot-captioning service.
+# A single worker keeps one copy of the model and one CUDA context; threads
+# overlap request parsing and image decoding with generation, which itself runs
+# on the app's single model thread (model_pool). The app is not
+# preloaded because a CUDA context created in the master does not survive fork.
+bind = '0.0.0.0:5556'
+workers = 1
+threads = 8
+preload_app = False
+# Model loading (and torch.compile warm-up) happens in the worker at boot
+timeout = 600
+
+
+def post_fork(server, worker):
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.init()
@@ -0,0 +1,9 @@
+-- Migration: Index shot comments by author and shot
+-- Lets "has this author already commented on this shot" checks (e.g. finding shots
+-- without a bot caption via NOT EXISTS / LEFT JOIN on shot_comments) use an
+-- index-only scan instead of scanning the comments table
+
+-- CONCURRENTLY avoids locking shot_comments against writes; it cannot run
+-- inside a transaction block, so apply this file on its own (e.g. psql -f)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_shot_comments_author_shot
+    ON shot_comments (author_id, shot_id);
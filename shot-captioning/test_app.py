@@ -0,0 +1,178 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import app
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def empty_caption_cache():
+    app.caption_cache.clear()
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    """Stub caption_batch with one that captions each image by its red value, recording the batch sizes"""
+    sizes = []
+
+    def caption_batch(images):
+        sizes.append(len(images))
+        return [f"red {image[0, 0, 0]}" for image in images]
+
+    monkeypatch.setattr(app, 'caption_batch', caption_batch)
+    return sizes
+
+
+class PilJpegDecoder:
+    """Stand-in with TurboJPEG's decode API for machines without the libturbojpeg shared library"""
+
+    def decode_header(self, jpeg_buf):
+        width, height = Image.open(io.BytesIO(jpeg_buf)).size
+        return width, height, 0, 0
+
+    def decode(self, jpeg_buf, pixel_format=None, scaling_factor=(1, 1), flags=0):
+        image = Image.open(io.BytesIO(jpeg_buf))
+        numerator, denominator = scaling_factor
+        width, height = image.size
+        size = (-(-width * numerator // denominator), -(-height * numerator // denominator))
+        return np.asarray(image.convert('RGB').resize(size))
+
+
+@pytest.fixture
+def jpeg_decoder(monkeypatch):
+    """Make sure decode_image takes the TurboJPEG branch, with the real library when it is installed"""
+    if app.jpeg is None:
+        monkeypatch.setattr(app, 'jpeg', PilJpegDecoder())
+        monkeypatch.setattr(app, 'TJPF_RGB', 0, raising=False)
+        monkeypatch.setattr(app, 'TJFLAG_FASTDCT', 2048, raising=False)
+    return app.jpeg
+
+
+def jpeg(size):
+    image = io.BytesIO()
+    Image.new('RGB', size, 'red').save(image, format='JPEG')
+    return image.getvalue()
+
+
+def png(red):
+    image = io.BytesIO()
+    Image.new('RGB', (32, 32), (red, 0, 0)).save(image, format='PNG')
+    return image.getvalue()
+
+
+def post_images(client, images_bytes):
+    return client.post('/caption', data={'image': [(io.BytesIO(b), f'{i}.png') for i, b in enumerate(images_bytes)]},
+                       content_type='multipart/form-data')
+
+
+def test_caption_returns_captions_in_upload_order_across_batches(client, batches, monkeypatch):
+    monkeypatch.setattr(app, 'CAPTION_BATCH_SIZE', 2)
+
+    response = post_images(client, [png(red) for red in (50, 40, 30, 20, 10)])
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert response.json == {
+        'captions': ['red 50', 'red 40', 'red 30', 'red 20', 'red 10'],
+        'errors': [None] * 5,
+    }
+    assert batches == [2, 2, 1]
+
+
+def test_caption_single_image_also_returns_caption(client, batches):
+    response = post_images(client, [png(10)])
+
+    assert response.status_code == 200
+    assert response.json == {'captions': ['red 10'], 'errors': [None], 'caption': 'red 10'}
+
+
+def test_caption_reports_undecodable_images_per_image(client, batches):
+    response = post_images(client, [png(10), b'not an image', png(20)])
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert response.json['captions'] == ['red 10', None, 'red 20']
+    errors = response.json['errors']
+    assert errors[0] is None and errors[2] is None
+    assert errors[1]
+    assert batches == [2]
+
+
+def test_caption_rejects_request_without_decodable_images(client, batches):
+    response = post_images(client, [b'not an image'])
+
+    assert response.status_code == 400
+    assert response.json['captions'] == [None]
+    assert response.json['caption'] is None
+    assert response.json['error'] == 'No image could be decoded'
+    assert batches == []
+
+
+def test_generate_captions_reuses_cached_captions(batches):
+    assert app.generate_captions([png(10)]) == (['red 10'], [None])
+    assert app.generate_captions([png(10)]) == (['red 10'], [None])
+
+    assert batches == [1]
+
+
+def test_generate_captions_captions_identical_images_once(batches):
+    captions, _ = app.generate_captions([png(10), png(20), png(10)])
+
+    assert captions == ['red 10', 'red 20', 'red 10']
+    assert batches == [2]
+
+
+def test_caption_cache_evicts_least_recently_used(batches, monkeypatch):
+    monkeypatch.setattr(app, 'CAPTION_CACHE_SIZE', 2)
+
+    app.generate_captions([png(10), png(20)])
+    # A hit makes red 10 the most recently used, so red 20 is evicted next
+    app.generate_captions([png(10)])
+    app.generate_captions([png(30)])
+
+    assert list(app.caption_cache.values()) == ['red 10', 'red 30']
+    app.generate_captions([png(10), png(20)])
+    assert batches == [2, 1, 1]
+
+
+def test_generate_captions_caches_nothing_on_failure(monkeypatch):
+    def caption_batch(images):
+        raise RuntimeError('CUDA out of memory')
+
+    monkeypatch.setattr(app, 'caption_batch', caption_batch)
+
+    with pytest.raises(RuntimeError):
+        app.generate_captions([png(10)])
+    assert app.generate_captions([b'not an image'])[0] == [None]
+    assert not app.caption_cache
+
+
+def test_decode_image_scales_large_jpegs_down_to_model_input_size(jpeg_decoder, monkeypatch):
+    monkeypatch.setattr(app, 'MODEL_INPUT_SIZE', 224)
+    decode = jpeg_decoder.decode
+    calls = []
+
+    def spy(*args, **kwargs):
+        calls.append((kwargs['scaling_factor'], kwargs['flags']))
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(jpeg_decoder, 'decode', spy)
+
+    # 900 // 224 = 4, so the JPEG is decoded at a quarter of its size
+    assert app.decode_image(jpeg((1000, 900))).shape == (225, 250, 3)
+    # Too small to shrink
+    assert app.decode_image(jpeg((300, 400))).shape == (400, 300, 3)
+    assert calls == [((1, 4), app.TJFLAG_FASTDCT), ((1, 1), app.TJFLAG_FASTDCT)]
+
+
+def test_decode_image_drafts_jpegs_without_turbojpeg(monkeypatch):
+    monkeypatch.setattr(app, 'jpeg', None)
+    monkeypatch.setattr(app, 'MODEL_INPUT_SIZE', 224)
+
+    # libjpeg's largest reduction that keeps both sides at least 224 is 1/4
+    assert app.decode_image(jpeg((1000, 900))).shape == (225, 250, 3)